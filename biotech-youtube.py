@@ -34,37 +34,56 @@ __license__ = 'MIT'
 # However, I take no responsibility for anything you do.
 
 import re
-import json
+import pickle
 
 from pathlib import Path
+from codecs import getincrementaldecoder
+from locale import getpreferredencoding
 from subprocess import Popen
-from logging import error, warning, exception
+from logging import error, warning, exception, disable, CRITICAL, NOTSET
 from urllib.parse import urlparse, quote
 from textwrap import wrap
 from shutil import which
 from sys import modules, argv
-from collections import Counter
+from collections import Counter, defaultdict
 from hashlib import md5
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import current_process, cpu_count
 
 RUNS_IN_IDLE = ('idlelib' in modules)
 
+# On some systems, processes parsing websites in parallel run this script
+# from the start. The main process has already shown the messages below.
+if current_process().name != 'MainProcess': disable( CRITICAL )
+
 ##################
 # External modules
 ##################
 
 # Beautiful Soup
 BeautifulSoup, NavigableString, FeatureNotFound = None, None, None
+EncodingDetector, UnicodeDammit = None, None
 
-try: from bs4 import BeautifulSoup, NavigableString, FeatureNotFound
+try:
+    from bs4 import BeautifulSoup, NavigableString, FeatureNotFound
+    from bs4.dammit import EncodingDetector, UnicodeDammit
 except Exception: error('Failed to import the BeautifulSoup package! '
                         'To install it, open your console and type:\n\n'
                         'pip install beautifulsoup4\nand then:\n'
                         'pip install lxml\n')
 
 # LXML
+etree = None
+AUTHOR_NAME_XPATH, HREF_XPATH = None, None
 if BeautifulSoup and FeatureNotFound:
     try:
         _ = BeautifulSoup( 'test', 'lxml' )
+        from lxml import etree
+
+        # Compiled once, because they're evaluated for every comment
+        AUTHOR_NAME_XPATH = etree.XPath( 'string(.//a[@id="author-text"])' )
+        HREF_XPATH = etree.XPath( './/a/@href' )
     except FeatureNotFound:
         error('[ERROR] No LXML library, impossible to read website content. '
               'Open your console and type:\n'
@@ -72,12 +91,18 @@ if BeautifulSoup and FeatureNotFound:
         BeautifulSoup = None
 
 # emoji
-UNICODE_EMOJI = []
+UNICODE_EMOJI = frozenset()
 try: from emoji import UNICODE_EMOJI
 except Exception:
-    error('Failed to import the "emoji" packages, emojis will not be shown '
-          'within the comments. To install it, open your console and type:\n'
-          'pip install emoji\n')
+    try: from emoji import EMOJI_DATA as UNICODE_EMOJI # emoji 2.0 and newer
+    except Exception:
+        error('Failed to import the "emoji" packages, emojis will not be '
+              'shown within the comments. To install it, open your console '
+              'and type:\npip install emoji\n')
+
+# Some versions group emojis by language, e.g. {'en': {...}, 'es': {...}}
+if 'en' in UNICODE_EMOJI: UNICODE_EMOJI = UNICODE_EMOJI['en']
+UNICODE_EMOJI = frozenset( UNICODE_EMOJI ) # Only the emojis, for fast lookups
 
 # dot
 DOT = which('dot')
@@ -98,9 +123,11 @@ MODULES_OK = BeautifulSoup
 SPECIAL_USERS = []
 SPECIAL_USER_STYLING = {}
 SPECIAL_USER_HASHES = set()
+ALL_SPECIAL_HASHES = frozenset() # Hashes from both of the above
+SPECIAL_NAMES = None # Plain names, if every special hash has a known name
 WEBSITES_TO_CLUSTERS = {}
 STARTING_CLUSTER = 'youtube'
-RESULT_FOLDER = 'TextSummaries'
+RESULT_FOLDER = Path('TextSummaries')
 
 #################################################
 # Configurable defaults, you can change them here
@@ -111,20 +138,25 @@ MAX_NODES_IN_COLUMN = 15
 BASE_EDGE_WIDTH = 2
 MINIMIZE_EDGE_NUMBER = False #If True, 1 edge = 1 comment
 GRAPH_ENGINES = ['dot'] # By default "dot" only, but you can try "neato" etc.
+PARALLEL_PARSING = True # Parse websites on all CPU cores at once
 
 #################################################
 # Catching YouTube comments from suspected trolls
 #################################################
 
+@lru_cache( maxsize=None )
 def _is_user_from_special_list( author ):
     '''
     Checks if a comment's author is among suspected troll accounts.
-    Caches username hashes to avoid costly computations.
+    The results are cached, since the same authors comment many times.
+    Note: only call it after the lists of suspected users are loaded.
     '''
-    is_special,namehash = False,None
+    # Most authors are not special, so skip hashing when it's safe
+    if SPECIAL_NAMES is not None and not author in SPECIAL_NAMES:
+        return False, None
+
     namehash = hash_username( author )
-    if namehash in SPECIAL_USER_HASHES or namehash in SPECIAL_USER_STYLING:
-        is_special = True
+    is_special = namehash in ALL_SPECIAL_HASHES
 
     return is_special, namehash
 
@@ -139,10 +171,13 @@ def find_troll_name_in_text( comment_body ):
     TODO: this is currently unused; would have to be added right after the
     "is_troll_comment" checked, for the Else... case.
     '''
+    global TROLL_RE
     if not TROLL_RE:
         # Make regex for finding non-mention usernames in text
-        re.compile( '[^@]({})'.format( '|'.join( SPECIAL_USERS )))
-        
+        # (compiled only once and reused for all comments)
+        usernames = '|'.join( re.escape( u ) for u in SPECIAL_USERS )
+        TROLL_RE = re.compile( '[^@]({})'.format( usernames ))
+
     trolls = TROLL_RE.search( comment_body.text )
     if trolls: trolls = list( trolls.groups() )
     return trolls
@@ -156,49 +191,28 @@ def _get_links_in_yt_comment_body( body ):
     return [l.text.strip() for l in body.find_all('a', attrs=tag_attrs)]
 
 
-def has_link_parent( elem: NavigableString ):
-    '''
-    Checks if a string of text nested deeper within elements has a
-    link container as a parent and thus is also a link.
-    '''
-    for p in elem.parents:
-        if p.name == 'a':
-            return True
-    return False
-
+WHITESPACE_RE = re.compile( r'(\s)\s+' )
 
 def gather_nested_text( textbox ):
     '''
-    Parses nested text of troll comments on YouTube
-    '''        
-    encountered_link = False
-    chunks = []
+    Parses nested text of troll comments on YouTube (plain text, links
+    and images) and squeezes repeated whitespace.
+    '''
+    parts = []
     for elem in textbox.descendants:
 
-        # Setting general helpful flags
-        if elem.name == 'a': encountered_link = True
+        if type(elem) is NavigableString:
+            parts.append( str(elem) )
 
-        # Tag-specific actions
-        if elem.name == 'img':
+        elif elem.name == 'img':
             try: alt_text = elem.attrs["alt"]
             except KeyError: alt_text = ''
 
-            if not alt_text: text = '[IMAGE]'
-            elif alt_text in UNICODE_EMOJI: text = alt_text
-            else: text = f'[IMAGE: "{alt_text}"]'
-                
-            chunks.append(('I',text))
-            
-        elif type(elem) == NavigableString:
-
-            if not encountered_link:
-                chunks.append(('T', str(elem)))
-            elif encountered_link:
-                is_link = has_link_parent( elem )
-                if is_link: chunks.append(('L', str(elem)))
-                else: chunks.append(('T', str(elem)))
+            if not alt_text: parts.append('[IMAGE]')
+            elif alt_text in UNICODE_EMOJI: parts.append( alt_text )
+            else: parts.append( f'[IMAGE: "{alt_text}"]' )
 
-    text = ' '.join( text for _,text in chunks )                                   
+    text = WHITESPACE_RE.sub( r'\g<1>', ' '.join( parts ) )
     return text
 
 
@@ -206,9 +220,8 @@ def parse_youtube_comment( comment ):
     '''Initially parses a YouTube comment, extracting author, link and text'''
 
     # Replace all relative links with absolute ones
-    for l in comment.find_all(True, attrs={'href':True}):
-        link = l.attrs['href'] 
-        if link.startswith('/'): l.attrs['href'] = 'www.youtube.com'+link
+    for l in comment.select('[href^="/"]'):
+        l.attrs['href'] = f'www.youtube.com{l.attrs["href"]}'
 
     author_box = comment.find( 'a', attrs={'id':'author-text'} )
     author = author_box.text.strip()
@@ -218,7 +231,6 @@ def parse_youtube_comment( comment ):
 
     textbox = comment.find(True, attrs={'id':'content-text'})
     text = gather_nested_text( textbox )
-    text = re.sub('(\s)\s+', '\g<1>', text)
 
     return [author, None, comment_link, text, None] #Nones for hash and links
 
@@ -226,18 +238,25 @@ def parse_youtube_comment( comment ):
 # Some name anonymizations
 ##########################
 
-HASHED_NAMES = {}
-
+@lru_cache( maxsize=None )
 def hash_username( username ):
+    '''
+    Gets an anonymous ID for a username. It is not about security,
+    but it has to stay MD5 to match the hashes in SPECIAL_USER_STYLING.
+    Cached, because the same users post many comments.
+    '''
     if not username: return ''
-    try: name_hash = HASHED_NAMES[ username ]
+    return md5( username.encode('utf-8') ).hexdigest()
+
+
+def _get_anonymous_id( user_name, user_map ):
+    '''Gets a number corresponding to the user's name'''
+    try: user_i = user_map[ user_name ]
     except KeyError:
-        hasher = md5()
-        hasher.update( bytes(username,'utf-8') )
-        name_hash = hasher.hexdigest()
-        HASHED_NAMES[ username ] = name_hash
+        user_i = len(user_map)
+        user_map[ user_name ] = user_i
 
-    return name_hash
+    return user_i
 
 
 def _replace_with_anonymous_id( text, user_name, user_map ):
@@ -245,27 +264,42 @@ def _replace_with_anonymous_id( text, user_name, user_map ):
     Gets a number corresponding to the user's name and replaces
     all occurrences of the name with a number.
     '''
-    try: user_i = user_map[ user_name ]
-    except KeyError:
-        user_i = len(user_map)
-        user_map[ user_name ] = user_i
-    
+    user_i = _get_anonymous_id( user_name, user_map )
     new_text = text.replace( user_name, f'[USER {user_i}]' )
     return new_text, user_i
 
 
-def anonymize_mention( user_mention, text, user_map ):
-    '''Anonymizes user mentions within the comment's body'''
-    user_name = user_mention.lstrip('@')
-    firstname = user_name.split(' ')[0]
+def _get_mention_replacements( usr_mentions, user_map ):
+    '''
+    Maps the names of mentioned users (and their first names)
+    to anonymous IDs, so that all of them can be replaced at once.
+    '''
+    user_names = [m.lstrip('@') for m in usr_mentions if m.lstrip('@')]
 
-    new_text, user_i = _replace_with_anonymous_id( text, user_name, user_map )
-    
-    if firstname != user_name:
-        new_text = new_text.replace( firstname, f'[USER {user_i} NAME]' )
+    replacements = {}
+    for user_name in user_names:
+        user_i = _get_anonymous_id( user_name, user_map )
+        replacements[ user_name ] = f'[USER {user_i}]'
+
+    # First names only after all full names, so they never replace them
+    for user_name in user_names:
+        firstname = user_name.split(' ')[0]
+        if firstname and not firstname in replacements:
+            user_i = user_map[ user_name ]
+            replacements[ firstname ] = f'[USER {user_i} NAME]'
+
+    return replacements
+
+
+@lru_cache( maxsize=256 )
+def _compile_alternation( names ):
+    '''
+    Compiles a regex matching any of the given names, longest first.
+    Cached, since the same people are mentioned in many comments.
+    '''
+    names = sorted( names, key=len, reverse=True )
+    return re.compile( '|'.join( re.escape( n ) for n in names ) )
 
-    return new_text
-            
 ANON_NAMESET = set()
 
 def anonymize_names( usr_mentions, author_re, com_data, user_map ):
@@ -276,10 +310,13 @@ def anonymize_names( usr_mentions, author_re, com_data, user_map ):
     For this reason, you can provide your custom ignore lists.
     '''
 
-    # First, replace active mentions given as links
+    # First, replace active mentions given as links, all in a single pass
+    # (longest names first, so that they win over their shorter parts)
     text = com_data[3]
-    for user_mention in usr_mentions:
-        text = anonymize_mention( user_mention, text, user_map )
+    replacements = _get_mention_replacements( usr_mentions, user_map )
+    if replacements:
+        mention_re = _compile_alternation( frozenset( replacements ) )
+        text = mention_re.sub( lambda m: replacements[ m.group(0) ], text )
 
     # Then replace non-link references (to old/inactive usernames)
     text = text.strip()
@@ -289,10 +326,12 @@ def anonymize_names( usr_mentions, author_re, com_data, user_map ):
 
     # Finally, use regex to replace in-text references to other users
     if author_re:
-        names = author_re.findall( text )
-        ANON_NAMESET.update( names ) #For debugging purposes
-        for name in sorted( names, reverse=True ): # Start from longest
-            text, _ = _replace_with_anonymous_id( text, name, user_map )
+        def anonymize_match( match ):
+            name = match.group(0)
+            ANON_NAMESET.add( name ) #For debugging purposes
+            return f'[USER {_get_anonymous_id( name, user_map )}]'
+
+        text = author_re.sub( anonymize_match, text )
 
     com_data[3] = text
 
@@ -303,13 +342,10 @@ def anonymize_names( usr_mentions, author_re, com_data, user_map ):
 def _save_to_textfile( data, filename ):
     '''
     A generic function to bundle all other ones and save text files
-    to a separate folder.
+    to a separate folder (which must already exist).
     '''
-    outfolder = Path( RESULT_FOLDER )
-    if not outfolder.exists(): outfolder.mkdir()
-    outpath = outfolder / filename
-    with open( outpath, 'w',  encoding='utf-8') as out:
-        out.write( data )
+    outpath = RESULT_FOLDER / filename
+    outpath.write_text( data, encoding='utf-8' )
 
 
 def _save_website_data( website_data ):
@@ -349,16 +385,13 @@ def _get_url_counts( connections ):
     Counts the websites which suspected comments are linking to
     and groups them by domains (e.g. youtube.com)
     '''
-    destinations = [dest for _,dest,_,_ in connections]
-    counts = sorted( list( Counter( destinations ).items()),
-                     key=lambda x: x[1] ) # By number
-    
-    counts_by_domain = {}
-    for url_info, num in counts:
-        url, domain = url_info
-        try: counts_by_domain[ domain ].append( (url,num) )
-        except KeyError: counts_by_domain[ domain ] = [(url,num)]
-    
+    counts = Counter( dest for _,dest,_,_ in connections )
+    counts = sorted( counts.items(), key=lambda x: x[1] ) # By number
+
+    counts_by_domain = defaultdict( list )
+    for (url, domain), num in counts:
+        counts_by_domain[ domain ].append( (url,num) )
+
     return counts_by_domain
 
 
@@ -378,54 +411,64 @@ def _save_url_counts( url_count_by_domain ):
 # Helper functions for adapting text and links
 ##############################################
 
-def get_title_and_link( html ):
-    '''Gets the link to the YouTube video under which comments were posted'''
-
-    website_title, link = '',''
-    
-    # Get the link to the video by looking at comment links
+def get_video_link( comment ):
+    '''
+    Gets the link to the YouTube video under which comments were posted,
+    by looking at the links of a single comment (as an lxml element)
+    '''
     # (warning: may fail if comment text contains links to other
     # YouTube comments, though it rarely ever happens)
-    
-    links = (l for l in html.find_all( 'a', attrs={'href':True}))
-    for l in links:
-        url = l.attrs['href']
+
+    for url in HREF_XPATH( comment ):
         if 'watch?v=' in url and '&lc=' in url:
             # Link to a specific comment; trim out comment parameter and
             # change relative path to an absolute one
             link = re.sub( '&lc=.*$', '', url)
             if link.startswith('/'): link = 'https://www.youtube.com' + link
-            break
+            return link
+
+    return ''
 
-    if 'youtube' in link:
-        try: website_title = html.find('title').string.strip()
-        except AttributeError: pass
-        
-    return website_title, link
 
+DOMAIN_START_RE = re.compile( r'^(.*?)/' )
+DOMAIN_RE = re.compile( r'[^.]+\.[^.]+$' )
 
+def _strip_scheme_and_www( link ):
+    '''
+    Removes "http(s)://" and a "www." of the domain from the start of
+    a link, so that the same websites can be compared.
+    '''
+    for scheme in ('https://', 'http://'):
+        if link[:len(scheme)].lower() == scheme:
+            link = link[len(scheme):]
+            break
+    if link[:4].lower() == 'www.': link = link[4:]
+    return link
+
+@lru_cache( maxsize=None )
 def _shorten_link( l ):
     '''
     Sometimes multiple links point to the same website. In order to avoid
     treating them as separate ones, we can trim them to their shortes form
     (no "www." in head or ".html" in tail etc.)
+    Cached, because the same links are posted over and over again.
     '''
     # The order of transformations should not be changed,
     # because urlparse can't find domain
     # without the HTTP(-S) indicator (and we want to remove it)
     
-    l = re.sub('www\.', '', l.lower())
+    l = l.lower()
+    domain = urlparse(l).netloc
+    l = _strip_scheme_and_www( l )
 
     # Try various ways of getting the domain
-    domain = urlparse(l).netloc
     if not domain:
-        dom_start_re = re.search('^(.*?)/', l)
+        dom_start_re = DOMAIN_START_RE.search( l )
         if dom_start_re: domain = dom_start_re.group(1)
     else:
-        dom_re = re.search('[^.]+\.[^.]+$', domain )
+        dom_re = DOMAIN_RE.search( domain )
         if dom_re: domain = dom_re.group(0)
         
-    l = re.sub('^https*://','', l)
     return l,domain
     
 
@@ -433,15 +476,17 @@ def _shorten_link( l ):
 # Modules responsible for graph creation
 ########################################
 
+SPECIAL_CHARS_RE = re.compile( r'[^A-Za-z ]+' )
+
+@lru_cache( maxsize=1024 )
 def _escape_special_chars( text ):
-        return re.sub('[^A-Za-z ]+','', text)
+    '''Leaves only letters and spaces, cached since names repeat a lot'''
+    return SPECIAL_CHARS_RE.sub( '', text )
 
 
 class GraphCreator:
 
     connections = []
-    _node_codes = {}
-    _current_node_num = 1
 
     HEAD = (
         '// Made using a script from ciemnastrona.com.pl.\n'
@@ -487,16 +532,20 @@ class GraphCreator:
     cluster_map = None
     domains_to_clusters = None
     starting_cluster = None
-    website_name_re = None
 
     SPECIAL_NODES = []
 
     GRAPH_TEMPLATE = None
     RENDERER = 'dot'
     GRAPH_FILE = 'graph.gv'
+    GRAPH_FOLDER = Path('LinkGraph')
 
     def __init__( self, cluster_map=None, starting_cluster=None ):
-        
+
+        # Formatted nodes, so that each one is formatted only once
+        self._node_codes = {}
+        self._current_node_num = 1
+
         if self.RENDERER == 'twopi':
             self.SELECTED_ATTRS = self.CIRCULAR_GRAPH_ATTRS
 
@@ -517,10 +566,6 @@ class GraphCreator:
             self.cluster_map = cluster_map
             self.domains_to_clusters = self._prepare_cluster_map( cluster_map )
 
-            special_domains = list(cluster_map.keys())
-            self.website_name_re = re.compile(
-                '({})'.format('|'.join( special_domains )))
-                  
         self.GRAPH_TEMPLATE = (
             f'{self.HEAD}\n'
             'digraph Connections {\n\n'
@@ -549,20 +594,24 @@ class GraphCreator:
         '''
         Formats the displayed text of a node by wrapping it. If it's
         one of the special nodes, it also sets its style attributes.
+        Repeated nodes get the result of their first formatting.
         '''
-        nodetext = nodetext.replace('\n','\\n')
-        try:
-            node_num = self._node_codes[ nodetext ]
-            label = ''
-        except KeyError:
-            node_num = self._current_node_num
+        try: return self._node_codes[ nodetext ]
+        except KeyError: pass
 
+        node_num = self._current_node_num
+        raw_nodetext = nodetext
+
+        nodetext = nodetext.replace('\n','\\n')
         oneline_text = nodetext.replace('\\n','')
         lowtext = oneline_text.lower()
 
-        match = self.website_name_re.search( lowtext )
-        if match:
-            fullname = self.domains_to_clusters[ match.group(1) ]
+        # Plain substring checks, since special domains are not patterns.
+        # The domain appearing earliest in the text decides the style.
+        matches = [d for d in self.domains_to_clusters if d in lowtext]
+        if matches:
+            match = min( matches, key=lowtext.find )
+            fullname = self.domains_to_clusters[ match ]
             styleinfo = WEBSITES_TO_CLUSTERS[ fullname ]
             styleinfo = ',style=filled,'+ styleinfo
         else:
@@ -579,7 +628,7 @@ class GraphCreator:
                          f'{styleinfo}]')
                          
         self._current_node_num += 1
-        self._node_codes[ nodetext ] = node_num
+        self._node_codes[ raw_nodetext ] = (node_num, graphviz_node)
             
         return node_num, graphviz_node
 
@@ -605,13 +654,13 @@ class GraphCreator:
         
         for clustname,nodes in clusters.items():
             unique_nodes = list(set(nodes))
-            clusters[clustname] = unique_nodes[:]
+            clusters[clustname] = unique_nodes
 
             unique_nodes = [(node,clustname) for node in unique_nodes]
             unique_nodes = self._sort_by_influence( unique_nodes, conn_num )
             
-            if clustname == 'nongrouped': normal_nodes = unique_nodes[:]
-            else: nodes_from_clusters += unique_nodes
+            if clustname == 'nongrouped': normal_nodes = unique_nodes
+            else: nodes_from_clusters.extend( unique_nodes )
 
         ordered_nodes = normal_nodes + nodes_from_clusters
         return ordered_nodes
@@ -672,14 +721,8 @@ class GraphCreator:
         
 
         # Grouping nodes into columns with a set max number of items
-        node_groups, buffer, i = [], [], 0
-        for n in nodes:
-            buffer.append( n )
-            if i == MAX_NODES_IN_COLUMN-1:
-                node_groups.append( buffer[:] )
-                buffer, i = [], 0
-            else: i += 1
-        if buffer: node_groups.append( buffer[:] )
+        node_groups = [nodes[i:i+MAX_NODES_IN_COLUMN]
+                       for i in range(0, len(nodes), MAX_NODES_IN_COLUMN)]
 
         # Padding the last column with empty items
         first_group, last_group = node_groups[0], node_groups[-1]
@@ -768,8 +811,13 @@ class GraphCreator:
         node_map = {}
         url_map = {}
         connections = []
-        clusters = {}
+        clusters = defaultdict( list )
         clusterized_nodes = set()
+        mapped_nodes = set()
+
+        # Names of special domains and their clusters, prepared only once
+        cluster_names = [(domain, _escape_special_chars( domain ))
+                         for domain in self.domains_to_clusters]
         
         for (source_info, target_info, author, _) in self.connections:
             
@@ -792,19 +840,20 @@ class GraphCreator:
 
             connections.append( (name1, name2, edgecolor) )
             
-            # Map to clusters
+            # Map to clusters (only once per node, most of them repeat)
             for s, slabel in ((site1, name1), (site2, name2)):
-                for clustname in self.domains_to_clusters.keys():
-                    if clustname in s.lower().replace('\n',''):
-                        clustname = _escape_special_chars( clustname )
-                        try: clusters[ clustname ].append( slabel )
-                        except KeyError: clusters[ clustname ] = [slabel]
+                if slabel in mapped_nodes: continue
+                mapped_nodes.add( slabel )
+
+                lowtext = s.lower().replace('\n','')
+                for domain, clustname in cluster_names:
+                    if domain in lowtext:
+                        clusters[ clustname ].append( slabel )
                         clusterized_nodes.add( slabel )
 
                 # Experimental, make cluster for nongrouped
                 if not slabel in clusterized_nodes:
-                    try: clusters[ 'nongrouped' ].append( slabel )
-                    except KeyError: clusters[ 'nongrouped' ] = [slabel]
+                    clusters[ 'nongrouped' ].append( slabel )
 
         return node_map, url_map, connections, clusters
 
@@ -816,10 +865,9 @@ class GraphCreator:
         print('Creating a link graph...')
 
         # Get inbound connections number
-        conn_num = Counter( c for _,c,_ in connections )
-        conn_num = {n: num for n, num in conn_num.items() }
-        for n in node_map:
-            if not n in conn_num: conn_num[n] = 0
+        conn_num = dict.fromkeys( node_map, 0 )
+        for _,c,_ in connections:
+            conn_num[c] = conn_num.get( c, 0 ) + 1
 
         reord = self.reorder_nodes_by_clusters
         ordered_nodes = reord( node_map, clusters, conn_num )
@@ -845,8 +893,8 @@ class GraphCreator:
     def _save_graph_to_file( self, graph: str ):
         '''Saves graph to disk as both instructions (gv) and rendered SVG'''              
 
-        outfolder = Path('LinkGraph')
-        if not outfolder.exists(): outfolder.mkdir()
+        outfolder = self.GRAPH_FOLDER
+        outfolder.mkdir( exist_ok=True )
 
         outpath = outfolder / self.GRAPH_FILE
         with open( outpath, 'w', encoding='utf-8') as out:
@@ -871,23 +919,21 @@ class GraphCreator:
 # either by parsing from scratch or grabbing a cached copy
 ##########################################################
 
-CACHE_FOLDER, CACHE_FILE = Path('cached_content'), 'website_data.json'
+CACHE_FOLDER, CACHE_FILE = Path('cached_content'), 'website_data.pkl'
 
-def _get_prepared_data( json_file ):
+def _get_prepared_data( cache_file ):
     
-    with open( json_file ) as j:
-        data = json.load( j )
-    print(f'Loaded data from {json_file}')
+    data = pickle.loads( cache_file.read_bytes() )
+    print(f'Loaded data from {cache_file}')
     return data
 
 
 def _save_prepared_data( data ):
     
     folder = CACHE_FOLDER
-    if not folder.exists(): folder.mkdir()
-    json_file = folder / CACHE_FILE
-    with open( json_file, 'w' ) as j:
-        json.dump( data, j )
+    folder.mkdir( exist_ok=True )
+    cache_file = folder / CACHE_FILE
+    cache_file.write_bytes( pickle.dumps( data, pickle.HIGHEST_PROTOCOL ) )
 
 
 def get_website_data( html_files ):
@@ -895,32 +941,97 @@ def get_website_data( html_files ):
     Gets all kinds of information available from a website: comments
     from specific trolls, links to external sources etc.
     '''
-    json_file = CACHE_FOLDER / CACHE_FILE
-    if json_file.exists():
-        data = _get_prepared_data( json_file )
+    cache_file = CACHE_FOLDER / CACHE_FILE
+    if cache_file.exists():
+        data = _get_prepared_data( cache_file )
         return data
     
     print(f'Preparing HTML files from scratch...')
+    parsed_websites = _parse_websites( html_files )
+
+    # One regex for names of commenters from all websites, compiled once
+    all_authors = set()
+    for parsed_website in parsed_websites:
+        if parsed_website: all_authors.update( parsed_website[2] )
+    author_re = _prepare_anonymizer_regex( all_authors )
+
+    # Anonymized one by one, to number the users the same way every time
     user_map, data_container = {}, []
-    for file in html_files:
-        prepare_website_data( file, data_container, user_map )
+    for file, parsed_website in zip( html_files, parsed_websites ):
+        prepare_website_data( file, parsed_website, author_re,
+                              data_container, user_map )
     data = data_container
     
     if data: _save_prepared_data( data )
     return data
 
 
-def _prepare_anonymizer_regex( coms_with_authors ):
+def _init_parsing_process( special_hashes, special_names ):
+    '''
+    Passes the suspected users to a process parsing websites, since it
+    does not always inherit them from the main one.
+    '''
+    global ALL_SPECIAL_HASHES, SPECIAL_NAMES
+    ALL_SPECIAL_HASHES = special_hashes
+    SPECIAL_NAMES = special_names
+    disable( NOTSET )
+
+
+def _parse_websites( html_files ):
+    '''
+    Parses websites in separate processes (one per CPU core), since
+    they do not depend on each other. Results keep the order of files.
+    '''
+    if not PARALLEL_PARSING or len( html_files ) < 2:
+        return [parse_website( file ) for file in html_files]
+
+    # No more processes than files, since each one has to start Python
+    workers = min( len( html_files ), cpu_count() )
+    with ProcessPoolExecutor( max_workers=workers,
+                              initializer=_init_parsing_process,
+                              initargs=(ALL_SPECIAL_HASHES,
+                                        SPECIAL_NAMES) ) as executor:
+        return list( executor.map( parse_website, html_files ) )
+
+
+def _make_trie_pattern( words ):
+    '''
+    Turns a list of words into a regex pattern in which words with common
+    beginnings share a single branch, e.g. "Jo(?:hn|e)" for "John" and "Joe".
+    This way, the regex engine doesn't have to try every word separately
+    at every position of the text. Longer words are preferred.
+    '''
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word: node = node.setdefault( char, {} )
+        node[''] = None # End of a word
+
+    def _node_to_pattern( node ):
+        branches = [ re.escape( char ) + _node_to_pattern( node[char] )
+                     for char in sorted( node ) if char ]
+        ends_here = '' in node
+        if not branches: return ''
+        if len(branches) == 1 and not ends_here: return branches[0]
+        
+        pattern = '(?:{})'.format('|'.join( branches ))
+        if ends_here: pattern += '?'
+        return pattern
+
+    return _node_to_pattern( trie )
+
+
+def _prepare_anonymizer_regex( authors ):
     '''
     Prepares a regex for anonymizing user names within the *text* of
     comments, which is then saved to a separate file.
     It is distinct from the anonymization of comment authors' names
     or user mentions ("@username" at comment start)
     '''
-    authors = list(set( re.escape( a )
-                        for _,a in coms_with_authors
-                        if (len(a) > 2 and not a in ANON_EXCLUSIONS)))
-    authors += ANON_INCLUSIONS
+    names = { a for a in authors
+              if (len(a) > 2 and not a in ANON_EXCLUSIONS) }
+    alternatives = [ _make_trie_pattern( names ) ] if names else []
+    alternatives += ANON_INCLUSIONS
 
     if ANON_EXCLUSIONS:
         print( f'[ANONYMIZER] Excluding {len(ANON_EXCLUSIONS)} text strings '
@@ -930,60 +1041,210 @@ def _prepare_anonymizer_regex( coms_with_authors ):
                ' text strings (potential names) within comment text')
     
     author_re = ''
-    if authors:
-        author_re = ('({})'.format('|'.join( authors )))     
+    if alternatives:
+        author_re = ('({})'.format('|'.join( alternatives )))     
         author_re = re.compile( r'\b' + author_re + r'\b', re.IGNORECASE)
         
     return author_re
 
 
-def prepare_website_data( html_file, data_container, user_map ):
-    '''Prepares website data from scratch'''
+STREAMED_TAGS = ('title', 'ytd-comment-renderer')
+PRUNED_TAGS = ('script', 'style') # Often big, but never needed
 
+def parse_website( html_file ):
+    '''
+    Parses a website from scratch, getting its title and link, names of
+    all commenters, and comments by suspected trolls (not anonymized yet).
+    Returns None if there are no comments.
+    '''
     print(f'Parsing {html_file}...')
-    name = 'youtube'
-    html = BeautifulSoup( open(html_file), 'lxml' )
-    website, link = get_title_and_link( html )
-    
-    links_from_main_page = []
-    troll_comments = []
-    refs_to_trolls = []
-   
-    comments = html.find_all('ytd-comment-renderer')
-    if not comments:
+
+    # Saved YouTube pages are UTF-8, so there's no need to guess.
+    # For other files, the first encoding that can decode the whole page:
+    # the declared one, the system's own (used by older versions of this
+    # script), and then the guesses BeautifulSoup would make.
+    encoding = 'utf-8'
+    page, is_utf8, fatal_error = _stream_page( html_file, encoding )
+    if not is_utf8:
+        warning(f'{html_file} is not in UTF-8, guessing its encoding '
+                '(it can take a while)')
+        raw_html = Path( html_file ).read_bytes()
+        declared = EncodingDetector.find_declared_encoding( raw_html,
+                                                            is_html=True )
+        candidates = [e for e in (declared, getpreferredencoding( False ))
+                      if e]
+        dammit = UnicodeDammit( raw_html, candidates, is_html=True,
+                                exclude_encodings=['utf-8'] )
+        encoding = dammit.original_encoding or 'windows-1252'
+        page, _, fatal_error = _stream_page( html_file, encoding )
+
+    # Streaming stops at text over ~10 MB (e.g. a huge inline script),
+    # which only a parser of the whole page allowed to go that big can read
+    if fatal_error:
+        warning(f'Failed to read {html_file} piece by piece '
+                f'({fatal_error.message.strip()}), '
+                'reading all of it at once instead')
+        page = _read_whole_page( html_file, encoding )
+        if page is None: return None
+
+    title, link, authors, troll_comments = page
+    if not authors:
         error(f'No comments found in {html_file}! '
               'Perhaps it is not a YouTube video or YT changed its format')
-        return
+        return None
 
-    coms_with_authors = []
-    for com in comments:
-        name_field = com.find('a', attrs={'id':'author-text'})
-        author = name_field.text.strip()
-        coms_with_authors.append( (com, author) )
+    website = ''
+    if 'youtube' in link and title: website = title.strip()
+
+    return website, link, authors, troll_comments
+
+
+class _UTF8CheckingReader:
+    '''
+    Passes a file on to the parser, checking on the way if it's valid
+    UTF-8. The parser can't be asked: it stops reporting errors after
+    the first 100 (e.g. the same IDs repeated in every comment).
+    '''
+    def __init__( self, file ):
+        self._file = file
+        self._decoder = getincrementaldecoder('utf-8')()
+        self.is_utf8 = True
+
+    def read( self, size=-1 ):
+        data = self._file.read( size )
+        if self.is_utf8:
+            try: self._decoder.decode( data, final=not data )
+            except UnicodeDecodeError: self.is_utf8 = False
+        return data
+
+
+def _stream_page( html_file, encoding ):
+    '''
+    Reads a page as it's being parsed, handling only the title and
+    comments. Returns the page's data, whether the page is valid UTF-8,
+    and the fatal error that stopped the parser early (if any).
+    '''
+    with open( html_file, 'rb' ) as f:
+        source = _UTF8CheckingReader( f )
+        elements = etree.iterparse( source, events=('end',),
+                                    tag=STREAMED_TAGS + PRUNED_TAGS,
+                                    html=True, encoding=encoding )
+        page = _read_page_elements( _prune_handled_elements( elements ) )
+
+        # The rest of the page has to be checked too
+        fatal_errors = elements.error_log.filter_from_fatals()
+        if fatal_errors:
+            while source.read( 1 << 20 ): pass
+
+    fatal_error = fatal_errors[0] if fatal_errors else None
+    return page, source.is_utf8, fatal_error
+
+
+def _prune_handled_elements( elements ):
+    '''
+    Passes on the title and comments of a page that's being parsed.
+    Once the next one is requested, the previous one is removed from
+    the tree, along with everything before it, since it's not needed.
+    Scripts and styles are removed as soon as they're parsed.
+    This way, the tree only holds what's after the last comment,
+    instead of the whole page.
+    '''
+    for _, elem in elements:
+        if not elem.tag in PRUNED_TAGS: yield elem
+        elem.clear( keep_tail=True )
+
+        # Parts of comments that are still being parsed have to stay
+        in_comment = next( elem.iterancestors('ytd-comment-renderer'), None )
+        if in_comment is not None: continue
+
+        node = elem
+        while node.getparent() is not None:
+            while node.getprevious() is not None: del node.getparent()[0]
+            node = node.getparent()
 
-    author_re = _prepare_anonymizer_regex( coms_with_authors )
-        
-    for com, author in coms_with_authors:
-        
-        is_from_list, namehash = _is_user_from_special_list( author )
-        if not is_from_list: continue
-        
-        # All the actions below apply only to comments by suspected trolls
 
-        com_data = parse_youtube_comment( com )
-        com_data[1] = namehash #Hash instead of link
+def _read_page_elements( elements ):
+    '''
+    Gets the title and video link of a page, names of all commenters,
+    and comments by suspected trolls, from the page's title and
+    comment elements (in the order of the page).
+    '''
+    title, link = None, ''
+    authors, troll_comments = [], []
+    try:
+        for elem in elements:
+
+            if elem.tag == 'title':
+                if title is None: title = elem.text or ''
+                continue
+
+            if not link: link = get_video_link( elem )
+
+            author = AUTHOR_NAME_XPATH( elem ).strip()
+            authors.append( author )
+            
+            is_from_list, namehash = _is_user_from_special_list( author )
+            if is_from_list:
+                troll_comments.append( _parse_troll_comment( elem, namehash ) )
+
+    except etree.XMLSyntaxError: pass # Empty file, no comments at all
+
+    return title, link, authors, troll_comments
+
+
+def _read_whole_page( html_file, encoding ):
+    '''
+    Parses a page that couldn't be streamed as a single tree, without
+    the size limits of streaming. Returns None if it can't be parsed.
+    '''
+    parser = etree.HTMLParser( huge_tree=True, encoding=encoding )
+    try: root = etree.parse( str( html_file ), parser ).getroot()
+    except etree.XMLSyntaxError as e:
+        error(f'Failed to parse {html_file}: {e}')
+        return None
+
+    elements = root.iter( *STREAMED_TAGS ) if root is not None else ()
+    return _read_page_elements( elements )
+
+
+def _parse_troll_comment( elem, namehash ):
+    '''
+    Parses a comment by a suspected troll. Only such comments are turned
+    into BeautifulSoup objects, to get their text, links and mentions.
+    '''
+    com_html = etree.tostring( elem, method='html', encoding='unicode',
+                               with_tail=False )
+    com = BeautifulSoup( com_html, 'lxml' )
+
+    com_data = parse_youtube_comment( com )
+    com_data[1] = namehash #Hash instead of link
+    
+    body = com.find('div', attrs={'id':'content'} )
+    com_links = _get_links_in_yt_comment_body( body )
+
+    usr_mentions, outbound_links = [], []
+    for cl in com_links:
+        if not cl.startswith('@'): outbound_links.append( cl )
+        else: usr_mentions.append( cl )
         
-        body = com.find('div', attrs={'id':'content'} )
-        com_links = _get_links_in_yt_comment_body( body )
+    com_data[-1] = outbound_links
+    return com_data, usr_mentions
+
+
+def prepare_website_data( html_file, parsed_website, author_re,
+                          data_container, user_map ):
+    '''Anonymizes a parsed website's data and adds it to the container'''
 
-        usr_mentions, outbound_links = [], []
-        for cl in com_links:
-            if not cl.startswith('@'): outbound_links.append( cl )
-            else: usr_mentions.append( cl )
+    if not parsed_website: return
+    website, link, _, parsed_comments = parsed_website
+
+    name = 'youtube'
+    links_from_main_page = []
+    troll_comments = []
+    refs_to_trolls = []
 
+    for com_data, usr_mentions in parsed_comments:
         anonymize_names( usr_mentions, author_re, com_data, user_map )
-            
-        com_data[-1] = outbound_links
         troll_comments.append( com_data )
 
     if not troll_comments:
@@ -994,15 +1255,32 @@ def prepare_website_data( html_file, data_container, user_map ):
     data_container.append( site_data )
 
 
+IMAGE_LINK_RE = re.compile( r'\.(?:png|jpe?g|gif|webp|svg)$', re.IGNORECASE )
+LINK_END_RE = re.compile( r'(?:\.html)?/*$' ) # ".html" and trailing slashes
+
+def _clean_link( link ):
+    '''Removes trailing slashes and the ".html" ending from a link'''
+    return LINK_END_RE.sub( '', link, count=1 )
+
+def _get_link_key( link ):
+    '''
+    Gets a form of a cleaned link used for finding duplicates: without
+    the scheme and "www.", and with a lowercase domain. The rest stays
+    as it is, since it can be case-sensitive (e.g. YouTube video IDs).
+    '''
+    domain, slash, path = _strip_scheme_and_www( link ).partition('/')
+    return domain.lower() + slash + path
+
+
 def get_links_and_comments( data, usernames ):
     '''
     Gets outbound links for a given website, both from the main page
     content and from individual troll comments.
     '''
     connections, website_links = list(), set()
-    troll_map = {}
+    troll_map = defaultdict( list )
 
-    trolls_by_name = {}
+    trolls_by_name = Counter()
     
     for website_data in data:
         
@@ -1012,21 +1290,20 @@ def get_links_and_comments( data, usernames ):
         if not website: website = link
 
         # Skip duplicates
-        link = link.rstrip('/') 
-        link = link.replace('.html', '')
-        if link in website_links:
-            if not urlparse(link).path: pass #Just the domain, let it be
+        link = _clean_link( link )
+        link_key = _get_link_key( link )
+        if link_key in website_links:
+            if not '/' in link_key: pass #Just the domain, let it be
             else:
                 warning(f'Found duplicate of {link}, skipping')
                 continue
-        else: website_links.add( link )
+        else: website_links.add( link_key )
 
         # Handle outbound links from main website content
         for l in main_links:
-            if re.search('(\.png|\.jpg)$', l): continue # Skip images
+            if IMAGE_LINK_RE.search( l ): continue # Skip images
             
-            l = l.rstrip('/')
-            l = l.replace('.html', '')
+            l = _clean_link( l )
             l,domain = _shorten_link( l )
             conn_info = ((website, None), (l,domain), None, name)
             connections.append( conn_info )
@@ -1036,11 +1313,8 @@ def get_links_and_comments( data, usernames ):
             
             name,ahash,_,_,troll_links = com_data
 
-            try: trolls_by_name[name] += 1
-            except KeyError: trolls_by_name[name] = 1
-                   
-            try: troll_map[ website ].append( com_data )
-            except KeyError: troll_map[ website ] = [ com_data ]
+            trolls_by_name[name] += 1
+            troll_map[ website ].append( com_data )
             
             for l in troll_links:
                 if not '.' in l or not '/' in l: continue #Skip fake links
@@ -1048,9 +1322,10 @@ def get_links_and_comments( data, usernames ):
                 conn_info = ((website,None), (l,domain), ahash, None)
                 connections.append( conn_info )
 
-    print('Number of comments made by suspected trolls:', trolls_by_name)
+    print('Number of comments made by suspected trolls:',
+          dict( trolls_by_name ))
     
-    troll_comments = troll_map
+    troll_comments = dict( troll_map )
     return connections, troll_comments
 
 ########################
@@ -1101,14 +1376,25 @@ def set_special_names_and_hashes( usernames ):
     Creates a script-wide list of usernames and hashes to be used
     for detecting troll comments and mentions of their names
     '''
-    if not usernames: return
+    global ALL_SPECIAL_HASHES, SPECIAL_NAMES
     
     for uname in usernames:
         SPECIAL_USERS.append( uname )
         namehash = hash_username( uname )
         SPECIAL_USER_HASHES.add( namehash )
 
-    print(f'[INFO] Loaded a list of {len(usernames)} suspected usernames')
+    # Merged once, so that checking comment authors takes a single lookup
+    ALL_SPECIAL_HASHES = (frozenset( SPECIAL_USER_HASHES )
+                          | frozenset( SPECIAL_USER_STYLING ))
+
+    # Authors can only be checked by name if no hash comes without one
+    SPECIAL_NAMES = None
+    if ALL_SPECIAL_HASHES <= SPECIAL_USER_HASHES:
+        SPECIAL_NAMES = frozenset( SPECIAL_USERS )
+    _is_user_from_special_list.cache_clear()
+
+    if usernames:
+        print(f'[INFO] Loaded a list of {len(usernames)} suspected usernames')
 
 #########################
 # Highest-level functions
@@ -1154,6 +1440,7 @@ def analyze_all_websites_in_folder( usernames, **graph_args ):
 
     print('\n[SUCCESS]\nLoaded all data for the saved YT videos '
           f'({len(data)})\n')
+    RESULT_FOLDER.mkdir( exist_ok=True )
     _save_website_data( data )
           
     connections, troll_comments = get_links_and_comments( data, usernames )